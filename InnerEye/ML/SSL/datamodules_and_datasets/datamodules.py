@@ -29,6 +29,7 @@ class InnerEyeVisionDataModule(VisionDataModule):
                  num_workers: int = 6,
                  batch_size: int = 32,
                  seed: int = 42,
+                 prefetch_factor: int = 4,
                  *args: Any, **kwargs: Any) -> None:
         """
         Wrapper around VisionDatamodule to load torchvision dataset into a pytorch-lightning module.
@@ -45,6 +46,8 @@ class InnerEyeVisionDataModule(VisionDataModule):
         :param num_workers: number of processes for dataloaders.
         :param batch_size: batch size for training & validation.
         :param seed: random seed for dataset splitting
+        :param prefetch_factor: number of batches loaded in advance by each dataloader worker. Ignored if
+        num_workers is 0.
         """
         data_dir = data_dir if data_dir is not None else os.getcwd()
         super().__init__(data_dir=data_dir,
@@ -62,6 +65,7 @@ class InnerEyeVisionDataModule(VisionDataModule):
         # In setup() VisionDataModule expects the extra arguments to be passed to the dataset class init
         # via the self.EXTRA_ARGS attribute
         self.EXTRA_ARGS = {"return_index": return_index}
+        self.prefetch_factor = prefetch_factor
 
     def prepare_data(self) -> None:
         """
@@ -71,6 +75,22 @@ class InnerEyeVisionDataModule(VisionDataModule):
         self.dataset_cls(self.data_dir, train=True, download=True, **self.EXTRA_ARGS)
         self.dataset_cls(self.data_dir, train=False, download=True, **self.EXTRA_ARGS)
 
+    def _data_loader(self, dataset: Dataset, shuffle: bool = False) -> DataLoader:
+        """
+        Creates a dataloader for the given dataset. In contrast to the VisionDataModule implementation, worker
+        processes are kept alive across epochs, and each worker prefetches more batches.
+        """
+        worker_kwargs: Dict[str, Any] = {}
+        if self.num_workers > 0:
+            worker_kwargs = {"persistent_workers": True, "prefetch_factor": self.prefetch_factor}
+        return DataLoader(dataset,
+                          batch_size=self.batch_size,
+                          shuffle=shuffle,
+                          num_workers=self.num_workers,
+                          drop_last=self.drop_last,
+                          pin_memory=self.pin_memory,
+                          **worker_kwargs)
+
     def _split_dataset(self, dataset: Dataset, train: bool = True) -> Dataset:
         """
         Splits the dataset into train and validation set
@@ -127,8 +147,10 @@ class CombinedDataModule(LightningDataModule):
         """
         self.encoder_module.prepare_data()
         self.linear_head_module.prepare_data()
+        # Create each of the dataloaders only once. The combined train_dataloader is a dictionary, its length is
+        # not the number of batches.
         logging.info(f"Len encoder train dataloader {len(self.encoder_module.train_dataloader())}")
-        logging.info(f"Len total train dataloader {len(self.train_dataloader())}")
+        logging.info(f"Len linear head train dataloader {len(self.linear_head_module.train_dataloader())}")
 
     def train_dataloader(self, *args: Any, **kwargs: Any) -> Dict[SSLDataModuleType, DataLoader]:
         """
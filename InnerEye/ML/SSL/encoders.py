@@ -2,7 +2,7 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
-
+import logging
 from typing import Optional, Union
 
 import pytorch_lightning as pl
@@ -55,6 +55,36 @@ class SSLEncoder(nn.Module):
         return get_encoder_output_dim(self)
 
 
+def to_encoder_memory_format(x: T, encoder: nn.Module) -> T:
+    """
+    Converts a batch of images to channels-last memory format if the convolution weights of the encoder are stored in
+    channels-last format (as done by SSLContainer when training on GPUs). Otherwise, the batch is returned unchanged.
+    :param x: The batch of images, of size [batch, channels, height, width].
+    :param encoder: The encoder that will process the images.
+    """
+    for parameter in encoder.parameters():
+        if parameter.dim() == 4:
+            if parameter.is_contiguous(memory_format=torch.channels_last):
+                return x.contiguous(memory_format=torch.channels_last)
+            break
+    return x
+
+
+def compile_ssl_encoders(model: nn.Module) -> None:
+    """
+    Compiles all SSL encoders inside the given model in place, with torch.compile. Compiling in place keeps the
+    parameter names in the checkpoints unchanged. If the installed version of PyTorch does not support
+    Module.compile(), a warning is logged and the model is left unchanged.
+    :param model: The model that contains the SSL encoders to compile.
+    """
+    if not hasattr(nn.Module, "compile"):
+        logging.warning("use_torch_compile is set, but the installed version of PyTorch does not support "
+                        "Module.compile(). The encoder will not be compiled.")
+        return
+    for encoder in [module for module in model.modules() if isinstance(module, SSLEncoder)]:
+        encoder.compile(mode="max-autotune")  # type: ignore
+
+
 def get_encoder_output_dim(pl_module: Union[pl.LightningModule, torch.nn.Module],
                            dm: Optional[pl.LightningDataModule] = None) -> int:
     """
@@ -9,6 +9,7 @@ from pathlib import Path
 from typing import Any, Dict, Optional, Tuple, Union
 
 import param
+import torch
 from pytorch_lightning import LightningModule
 from yacs.config import CfgNode
 
@@ -18,7 +19,7 @@ from InnerEye.ML.SSL.datamodules_and_datasets.datamodules import CombinedDataMod
 from InnerEye.ML.SSL.datamodules_and_datasets.transforms_utils import InnerEyeCIFARLinearHeadTransform, \
     InnerEyeCIFARTrainTransform, \
     get_cxr_ssl_transforms
-from InnerEye.ML.SSL.encoders import get_encoder_output_dim
+from InnerEye.ML.SSL.encoders import compile_ssl_encoders, get_encoder_output_dim
 from InnerEye.ML.SSL.lightning_modules.byol.byol_module import BYOLInnerEye
 from InnerEye.ML.SSL.lightning_modules.simclr_module import SimCLRInnerEye
 from InnerEye.ML.SSL.lightning_modules.ssl_online_evaluator import SSLOnlineEvaluatorInnerEye
@@ -93,6 +94,9 @@ class SSLContainer(LightningContainer):
     linear_head_dataset_name = param.ClassSelector(class_=SSLDatasetName,
                                                    doc="Name of the dataset to use for the linear head training")
     linear_head_batch_size = param.Integer(default=256, doc="Batch size for linear head tuning")
+    use_torch_compile = param.Boolean(default=False,
+                                      doc="If True, compile the SSL encoder(s) with torch.compile for faster training. "
+                                          "This requires PyTorch 2.2 or newer, and is ignored otherwise.")
     learning_rate_linear_head_during_ssl_training = param.Number(default=1e-4,
                                                                  doc="Learning rate for linear head training during "
                                                                      "SSL training.")
@@ -164,7 +168,14 @@ class SSLContainer(LightningContainer):
                 f"Found {self.ssl_training_type.value}")
         model.hparams.update({'ssl_type': self.ssl_training_type.value,
                               "num_classes": self.data_module.num_classes})
+        if self.total_num_gpus > 0:
+            # Channels-last memory format enables the faster NHWC convolution kernels on tensor core GPUs.
+            # The input images are converted to the same format in the forward pass of the SSL modules.
+            model = model.to(memory_format=torch.channels_last)  # type: ignore
         self.encoder_output_dim = get_encoder_output_dim(model, self.data_module)
+        if self.use_torch_compile:
+            # Compile only after computing the output dimension, to avoid compiling for the shape of the dummy batch.
+            compile_ssl_encoders(model)
 
         return model
 
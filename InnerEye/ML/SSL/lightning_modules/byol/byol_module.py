@@ -12,8 +12,9 @@ import torch.nn.functional as F
 from pl_bolts.optimizers.lars_scheduling import LARSWrapper
 from pl_bolts.optimizers.lr_scheduler import LinearWarmupCosineAnnealingLR
 from torch import Tensor as T
-from torch.optim import Adam
+from torch.optim import Adam, Optimizer
 
+from InnerEye.ML.SSL.encoders import to_encoder_memory_format
 from InnerEye.ML.SSL.lightning_modules.byol.byol_models import SiameseArm
 from InnerEye.ML.SSL.lightning_modules.byol.byol_moving_average import ByolMovingAverageWeightUpdate
 from InnerEye.ML.SSL.utils import SSLDataModuleType
@@ -61,8 +62,14 @@ class BYOLInnerEye(pl.LightningModule):
         # Add callback for user automatically since it's key to BYOL weight update
         self.weight_callback.on_before_zero_grad(self.trainer, self)
 
+    def optimizer_zero_grad(self, epoch: int, batch_idx: int, optimizer: Optimizer, optimizer_idx: int) -> None:
+        """
+        Resets the gradients by setting them to None, rather than writing zeros into all gradient buffers.
+        """
+        optimizer.zero_grad(set_to_none=True)
+
     def forward(self, x: T) -> T:  # type: ignore
-        return self.target_network.encoder(x)
+        return self.target_network.encoder(to_encoder_memory_format(x, self.target_network.encoder))
 
     @staticmethod
     def cosine_loss(a: T, b: T) -> T:
@@ -84,6 +91,8 @@ class BYOLInnerEye(pl.LightningModule):
         """
         batch = batch[SSLDataModuleType.ENCODER] if isinstance(batch, dict) else batch
         (img_1, img_2), _ = batch
+        img_1 = to_encoder_memory_format(img_1, self.online_network.encoder)
+        img_2 = to_encoder_memory_format(img_2, self.online_network.encoder)
 
         # Image 1 to image 2 loss
         h_img1 = self.online_network(img_1)
@@ -10,8 +10,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 from pl_bolts.models.self_supervised.simclr.simclr_module import SimCLR
 from torch import Tensor as T
+from torch.optim import Optimizer
 
-from InnerEye.ML.SSL.encoders import SSLEncoder
+from InnerEye.ML.SSL.encoders import SSLEncoder, to_encoder_memory_format
 from InnerEye.ML.SSL.utils import SSLDataModuleType
 
 SingleBatchType = Tuple[List, T]
@@ -55,7 +56,13 @@ class SimCLRInnerEye(SimCLR):
         self.projection = _Projection(input_dim=self.encoder.get_output_feature_dim(), hidden_dim=2048, output_dim=128)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        return self.encoder(x)
+        return self.encoder(to_encoder_memory_format(x, self.encoder))
+
+    def optimizer_zero_grad(self, epoch: int, batch_idx: int, optimizer: Optimizer, optimizer_idx: int) -> None:
+        """
+        Resets the gradients by setting them to None, rather than writing zeros into all gradient buffers.
+        """
+        optimizer.zero_grad(set_to_none=True)
 
     def shared_step(self, batch: BatchType) -> T:
         batch = batch[SSLDataModuleType.ENCODER] if isinstance(batch, dict) else batch
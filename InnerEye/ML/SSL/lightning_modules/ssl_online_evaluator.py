@@ -128,7 +128,7 @@ class SSLOnlineEvaluatorInnerEye(SSLOnlineEvaluator):
             loss = self.shared_step(batch, pl_module, is_training=True)
             loss.backward()
             self.optimizer.step()
-            self.optimizer.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
 
             # log metrics
             pl_module.log('ssl_online_evaluator/train/loss', loss)
@@ -2,11 +2,24 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+import os
+
+import torch
 
 from InnerEye.ML.SSL.lightning_containers.ssl_container import EncoderName, SSLContainer, SSLDatasetName
 from InnerEye.ML.SSL.utils import SSLTrainingType
 
 
+def get_num_workers_per_gpu(max_num_workers: int = 10) -> int:
+    """
+    Gets the number of dataloader worker processes to use, by splitting the available CPU cores evenly across the GPUs
+    of the machine (each GPU is served by its own DDP process).
+    :param max_num_workers: The maximum number of workers to return.
+    """
+    num_cpus = os.cpu_count() or 1
+    return min(num_cpus // max(1, torch.cuda.device_count()), max_num_workers)
+
+
 class CIFAR10SimCLR(SSLContainer):
     """
     This module trains an SSL encoder using SimCLR on CIFAR10 and finetunes a linear head on CIFAR10 too.
@@ -21,7 +34,7 @@ class CIFAR10SimCLR(SSLContainer):
                          random_seed=1,
                          recovery_checkpoint_save_interval=200,
                          num_epochs=2500,
-                         num_workers=6)
+                         num_workers=get_num_workers_per_gpu())
 
 
 class CIFAR10BYOL(SSLContainer):
@@ -38,7 +51,7 @@ class CIFAR10BYOL(SSLContainer):
                          random_seed=1,
                          recovery_checkpoint_save_interval=200,
                          num_epochs=2500,
-                         num_workers=6)
+                         num_workers=get_num_workers_per_gpu())
 
 
 class CIFAR10CIFAR100BYOL(SSLContainer):
@@ -55,4 +68,4 @@ class CIFAR10CIFAR100BYOL(SSLContainer):
                          random_seed=1,
                          recovery_checkpoint_save_interval=200,
                          num_epochs=2500,
-                         num_workers=6)
+                         num_workers=get_num_workers_per_gpu())
@@ -475,6 +475,11 @@ class TrainerParams(param.Parameterized):
                                                     "training.")
     use_mixed_precision: bool = param.Boolean(False, doc="If true, mixed precision training is activated during "
                                                          "training.")
+    use_bfloat16: bool = param.Boolean(False, doc="If true, mixed precision training is done in bfloat16 rather than "
+                                                  "float16. bfloat16 has the same exponent range as float32, hence no "
+                                                  "gradient scaling is required. This takes precedence over "
+                                                  "use_mixed_precision, and requires a GPU with bfloat16 support "
+                                                  "(Ampere or later) and PyTorch Lightning 1.5 or newer.")
     max_num_gpus: int = param.Integer(default=-1, doc="The maximum number of GPUS to use. If set to a value < 0, use"
                                                       "all available GPUs. In distributed training, this is the "
                                                       "maximum number of GPUs per node.")
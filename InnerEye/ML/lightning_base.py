@@ -15,6 +15,7 @@ from torch.optim import Optimizer
 from torch.optim.lr_scheduler import _LRScheduler
 from torch.utils.data import DataLoader, Dataset
 
+from InnerEye.Azure.azure_util import RUN_CONTEXT
 from InnerEye.Common.common_util import EPOCH_METRICS_FILE_NAME, logging_section
 from InnerEye.Common.metrics_constants import LoggingColumns, MetricType, TRAIN_PREFIX, VALIDATION_PREFIX
 from InnerEye.Common.type_annotations import DictStrFloat
@@ -192,7 +193,11 @@ class InnerEyeContainer(LightningContainer):
 
         # Print out a detailed breakdown of layers, memory consumption and time.
         assert isinstance(self.model, InnerEyeLightning)
-        generate_and_print_model_summary(self.config, self.model.model)
+        if self.config.print_model_summary:
+            generate_and_print_model_summary(self.config, self.model.model)
+        else:
+            # The model summary also logs the number of trainable parameters, which is cheap to compute without it.
+            RUN_CONTEXT.log(LoggingColumns.NumTrainableParameters, self.model.model.get_number_trainable_parameters())
 
     def load_checkpoint_and_modify(self, path_to_checkpoint: Path) -> Dict[str, Any]:
         return self.config.load_checkpoint_and_modify(path_to_checkpoint=path_to_checkpoint)
@@ -312,7 +317,7 @@ class InnerEyeLightning(LightningModule):
         Training and Validation metrics.
         """
         if epoch >= 0:
-            if epoch in self.storing_logger.results:
+            if epoch in self.storing_logger.epochs:
                 for is_training, prefix in [(True, TRAIN_PREFIX), (False, VALIDATION_PREFIX)]:
                     metrics = self.storing_logger.extract_by_prefix(epoch, prefix)
                     self.store_epoch_results(metrics, epoch, is_training)
@@ -2,8 +2,11 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+import queue
+import threading
 from typing import Any, Dict, Iterable, List, Optional
 
+import numpy as np
 from pytorch_lightning.loggers import LightningLoggerBase
 from pytorch_lightning.utilities import rank_zero_only
 
@@ -11,16 +14,27 @@ from InnerEye.Azure.azure_util import RUN_CONTEXT, is_offline_run_context
 from InnerEye.Common.metrics_constants import TRAIN_PREFIX, VALIDATION_PREFIX
 from InnerEye.Common.type_annotations import DictStrFloat
 
+# The number of epochs for which space is allocated when the StoringLogger receives its first metrics.
+INITIAL_EPOCH_CAPACITY = 64
+
 
 class StoringLogger(LightningLoggerBase):
     """
     A Pytorch Lightning logger that simply stores the metrics that are written to it.
     Used for diagnostic purposes in unit tests.
+    Metrics are stored column-wise, with one array per metric that holds the values for all epochs. The arrays grow
+    as more epochs are logged.
     """
 
     def __init__(self) -> None:
         super().__init__()
-        self.results: Dict[int, DictStrFloat] = {}
+        # Maps from epoch number to the row index in the metric arrays, in the order in which epochs were logged.
+        self._epoch_to_row: Dict[int, int] = {}
+        # Maps from metric name to an array with the metric values, one entry per row (epoch).
+        self._metric_arrays: Dict[str, np.ndarray] = {}
+        # Maps from metric name to a boolean array that indicates for which rows (epochs) the metric has been logged.
+        self._metric_present: Dict[str, np.ndarray] = {}
+        self._capacity = INITIAL_EPOCH_CAPACITY
         self.hyperparams: Any = None
         # Fields to store diagnostics for unit testing
         self.train_diagnostics: List[Any] = []
@@ -33,15 +47,39 @@ class StoringLogger(LightningLoggerBase):
             raise ValueError("Each of the logged metrics should have an 'epoch' key.")
         epoch = int(metrics[epoch_name])
         del metrics[epoch_name]
-        if epoch in self.results:
-            current_results = self.results[epoch]
-            overlapping_keys = set(metrics.keys()).intersection(current_results.keys())
+        row = self._epoch_to_row.get(epoch, None)
+        if row is None:
+            row = self._add_epoch(epoch)
+        else:
+            overlapping_keys = [key for key in metrics.keys()
+                                if key in self._metric_present and self._metric_present[key][row]]
             if len(overlapping_keys) > 0:
                 raise ValueError(f"Unable to log metric with same name twice for epoch {epoch}: "
                                  f"{', '.join(overlapping_keys)}")
-            current_results.update(metrics)
-        else:
-            self.results[epoch] = metrics
+        for key, value in metrics.items():
+            if key not in self._metric_arrays:
+                self._metric_arrays[key] = np.full(self._capacity, np.nan, dtype=np.float64)
+                self._metric_present[key] = np.zeros(self._capacity, dtype=np.bool_)
+            self._metric_arrays[key][row] = value
+            self._metric_present[key][row] = True
+
+    def _add_epoch(self, epoch: int) -> int:
+        """
+        Adds a row for the given epoch to all metric arrays, growing the arrays if needed.
+        :return: The row index for the new epoch.
+        """
+        row = len(self._epoch_to_row)
+        if row >= self._capacity:
+            self._capacity *= 2
+            for key in self._metric_arrays.keys():
+                values = np.full(self._capacity, np.nan, dtype=np.float64)
+                values[:row] = self._metric_arrays[key]
+                self._metric_arrays[key] = values
+                present = np.zeros(self._capacity, dtype=np.bool_)
+                present[:row] = self._metric_present[key]
+                self._metric_present[key] = present
+        self._epoch_to_row[epoch] = row
+        return row
 
     @rank_zero_only
     def log_hyperparams(self, params: Any) -> None:
@@ -61,7 +99,14 @@ class StoringLogger(LightningLoggerBase):
         """
         Gets the epochs for which the present object holds any results.
         """
-        return self.results.keys()
+        return self._epoch_to_row.keys()
+
+    @property
+    def results(self) -> Dict[int, DictStrFloat]:
+        """
+        Gets all stored metrics as a two-level dictionary, mapping from epoch number to metric name to metric value.
+        """
+        return self.to_metrics_dicts()
 
     def extract_by_prefix(self, epoch: int, prefix_filter: str = "") -> DictStrFloat:
         """
@@ -73,17 +118,16 @@ class StoringLogger(LightningLoggerBase):
         have a name starting with `prefix`, and strip off the prefix.
         :return: A metrics dictionary.
         """
-        epoch_results = self.results.get(epoch, None)
-        if epoch_results is None:
+        row = self._epoch_to_row.get(epoch, None)
+        if row is None:
             raise KeyError(f"No results are stored for epoch {epoch}")
         filtered = {}
-        for key, value in epoch_results.items():
-            assert isinstance(key, str), f"All dictionary keys should be strings, but got: {type(key)}"
+        for key, values in self._metric_arrays.items():
             # Add the metric if either there is no prefix filter (prefix does not matter), or if the prefix
             # filter is supplied and really matches the metric name
-            if (not prefix_filter) or key.startswith(prefix_filter):
+            if self._metric_present[key][row] and ((not prefix_filter) or key.startswith(prefix_filter)):
                 stripped_key = key[len(prefix_filter):]
-                filtered[stripped_key] = value
+                filtered[stripped_key] = float(values[row])
         return filtered
 
     def to_metrics_dicts(self, prefix_filter: str = "") -> Dict[int, DictStrFloat]:
@@ -97,6 +141,19 @@ class StoringLogger(LightningLoggerBase):
         """
         return {epoch: self.extract_by_prefix(epoch, prefix_filter) for epoch in self.epochs}
 
+    def get_metric_array(self, metric_name: str) -> np.ndarray:
+        """
+        Gets the values that a metric attains in all of the epochs, as a numpy array with one entry per epoch.
+        :param metric_name: The full name of the metric, including its prefix.
+        :return: An array of metric values, in the order in which the epochs were logged.
+        """
+        if metric_name not in self._metric_arrays:
+            raise KeyError(f"No results are stored for metric {metric_name}")
+        num_epochs = len(self._epoch_to_row)
+        if not self._metric_present[metric_name][:num_epochs].all():
+            raise KeyError(f"Metric {metric_name} is not available for all epochs")
+        return self._metric_arrays[metric_name][:num_epochs]
+
     def get_metric(self, is_training: bool, metric_type: str) -> List[float]:
         """
         Gets a scalar metric out of either the list of training or the list of validation results. This returns
@@ -107,7 +164,7 @@ class StoringLogger(LightningLoggerBase):
         :return: A list of floating point numbers, with one entry per entry in the the training or validation results.
         """
         full_metric_name = (TRAIN_PREFIX if is_training else VALIDATION_PREFIX) + metric_type
-        return [self.results[epoch][full_metric_name] for epoch in self.epochs]
+        return self.get_metric_array(full_metric_name).tolist()
 
     def get_train_metric(self, metric_type: str) -> List[float]:
         """
@@ -168,3 +225,79 @@ class AzureMLLogger(LightningLoggerBase):
 
     def version(self) -> int:
         return 0
+
+
+class AsyncAzureMLLogger(AzureMLLogger):
+    """
+    A Pytorch Lightning logger that stores metrics in the current AzureML run, like AzureMLLogger. The calls to the
+    AzureML run are made on a background thread, so that the training loop does not wait for them. All queued
+    metrics are written when the logger is closed. The background thread is a daemon thread, hence the logger must be
+    closed also when training fails, otherwise queued metrics may be lost.
+    """
+
+    def __init__(self, max_queue_size: int = 1024) -> None:
+        """
+        :param max_queue_size: The maximum number of calls to log_metrics that can be queued up. When the queue
+        is full, log_metrics blocks until the background thread has caught up.
+        """
+        super().__init__()
+        self.max_queue_size = max_queue_size
+        # The queue and the thread are only created when the first metrics are logged, so that the logger can still
+        # be pickled before training starts.
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[Exception] = None
+
+    @rank_zero_only
+    def log_metrics(self, metrics: Dict[str, float], step: Optional[int] = None) -> None:
+        if self.is_azureml_run:
+            if self._error is not None:
+                # Stop the background thread and raise the error that it encountered.
+                self.flush()
+            if self._queue is None or self._thread is None:
+                self._queue = queue.Queue(maxsize=self.max_queue_size)
+                self._thread = threading.Thread(target=self._log_from_queue, args=(self._queue,), daemon=True)
+                self._thread.start()
+            self._queue.put(dict(metrics))
+
+    def _log_from_queue(self, metrics_queue: queue.Queue) -> None:
+        """
+        Writes all metrics that are put into the queue to the AzureML run, until a None item is read from the queue.
+        If writing fails, the exception is stored and raised on the main thread in the next call to log_metrics or
+        flush. All further metrics are discarded, but the queue is still emptied so that log_metrics does not block.
+        """
+        while True:
+            metrics = metrics_queue.get()
+            if metrics is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                for key, value in metrics.items():
+                    RUN_CONTEXT.log(key, value)
+            except Exception as ex:
+                self._error = ex
+
+    def flush(self) -> None:
+        """
+        Blocks until all queued metrics have been written to the AzureML run, and stops the background thread.
+        Any exception that occurred while writing the metrics is raised here.
+        """
+        if self._queue is not None and self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+        self._queue = None
+        self._thread = None
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    @rank_zero_only
+    def finalize(self, status: str) -> None:
+        self.flush()
+        super().finalize(status)
+
+    def close(self) -> None:
+        self.flush()
+        super().close()
@@ -8,6 +8,7 @@ from pathlib import Path
 from typing import Any, Callable, Dict, Optional
 
 import pandas as pd
+import param
 from azureml.core import ScriptRunConfig
 from azureml.train.hyperdrive import GridParameterSampling, HyperDriveConfig, PrimaryMetricGoal, choice
 from pandas import DataFrame
@@ -29,6 +30,11 @@ class ModelConfigBaseMeta(type(DeepLearningConfig), abc.ABCMeta):  # type: ignor
 
 
 class ModelConfigBase(DeepLearningConfig, abc.ABC, metaclass=ModelConfigBaseMeta):
+    print_model_summary: bool = param.Boolean(True,
+                                              doc="If True, print a detailed breakdown of layers, memory consumption "
+                                                  "and time before training starts. This requires a forward pass "
+                                                  "through the model, set to False to start training faster. "
+                                                  "The number of trainable parameters is logged in either case.")
 
     def __init__(self, **params: Any):
         super().__init__(**params)
@@ -2,19 +2,27 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+import itertools
 import logging
 import os
+import shutil
 import subprocess
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor
+from distutils.version import LooseVersion
 from pathlib import Path
 from time import sleep
-from typing import Any, Dict, Optional, Tuple, TypeVar
+from typing import Any, Dict, List, Optional, Tuple, TypeVar, Union
 
 import numpy as np
+import pytorch_lightning
+import torch
 from pytorch_lightning import LightningModule, Trainer, seed_everything
 from pytorch_lightning.callbacks import ModelCheckpoint
 from pytorch_lightning.loggers import TensorBoardLogger
 from pytorch_lightning.plugins import DDPPlugin
+from pytorch_lightning.utilities.apply_func import apply_to_collection
+from pytorch_lightning.utilities.cloud_io import atomic_save
 from pytorch_lightning.utilities.exceptions import MisconfigurationException
 
 from InnerEye.Azure.azure_runner import ENV_GLOBAL_RANK, ENV_LOCAL_RANK, ENV_NODE_RANK
@@ -25,12 +33,16 @@ from InnerEye.ML.common import ModelExecutionMode, RECOVERY_CHECKPOINT_FILE_NAME
 from InnerEye.ML.deep_learning_config import ARGS_TXT, VISUALIZATION_FOLDER
 from InnerEye.ML.lightning_base import InnerEyeContainer, InnerEyeLightning
 from InnerEye.ML.lightning_container import LightningContainer
-from InnerEye.ML.lightning_loggers import AzureMLLogger, StoringLogger
+from InnerEye.ML.lightning_loggers import AsyncAzureMLLogger, StoringLogger
 from InnerEye.ML.lightning_models import SUBJECT_OUTPUT_PER_RANK_PREFIX, ScalarLightning, \
     get_subject_output_file_per_rank
 from InnerEye.ML.utils.checkpoint_handling import CheckpointHandler
 
 TEMP_PREFIX = "temp/"
+# The buffer size used when concatenating per-rank output files.
+COPY_BUFFER_SIZE = 1024 * 1024
+# The maximum number of threads to use when downloading per-rank output files.
+MAX_DOWNLOAD_THREADS = 32
 
 T = TypeVar('T')
 
@@ -38,9 +50,12 @@ T = TypeVar('T')
 def is_global_rank_zero() -> bool:
     """
     Tries to guess if the current process is running as DDP rank zero, before the training has actually started,
-    by looking at environment variables.
+    by looking at environment variables. If torch.distributed has already been initialized, the rank is read from
+    there instead.
     :return: True if the current process is global rank 0.
     """
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank() == 0
     # When doing multi-node training, this indicates which node the present job is on. This is set in
     # set_environment_variables_for_multi_node
     node_rank = os.getenv(ENV_NODE_RANK, "0")
@@ -71,6 +86,26 @@ def upload_output_file_as_temp(file_path: Path, outputs_folder: Path) -> None:
     RUN_CONTEXT.upload_file(upload_name, path_or_stream=str(file_path))
 
 
+def download_output_files_from_all_ranks(world_size: int, outputs_folder: Path) -> None:
+    """
+    Downloads the per-rank subject output files for training and validation, that all ranks uploaded to the AzureML
+    run via upload_output_file_as_temp. Downloads are run in parallel, because they are bound by network latency.
+    :param world_size: The number of ranks that took part in training.
+    :param outputs_folder: The root folder that contains all training outputs. Files will be downloaded into
+    subfolders for each execution mode.
+    """
+    files = [mode.value + "/" + get_subject_output_file_per_rank(rank)
+             for rank, mode in itertools.product(range(world_size),
+                                                 [ModelExecutionMode.TRAIN, ModelExecutionMode.VAL])]
+
+    def download(file: str) -> None:
+        RUN_CONTEXT.download_file(name=TEMP_PREFIX + file, output_file_path=outputs_folder / file)
+
+    with ThreadPoolExecutor(max_workers=min(MAX_DOWNLOAD_THREADS, len(files))) as executor:
+        # Consume the results, so that exceptions in any of the downloads are raised here
+        list(executor.map(download, files))
+
+
 def write_args_file(config: Any, outputs_folder: Path) -> None:
     """
     Writes the given config to disk in plain text in the default output folder.
@@ -82,7 +117,74 @@ def write_args_file(config: Any, outputs_folder: Path) -> None:
     logging.info(output)
 
 
-class InnerEyeRecoveryCheckpointCallback(ModelCheckpoint):
+class InnerEyeModelCheckpoint(ModelCheckpoint):
+    """
+    A checkpoint callback that writes checkpoints to disk on a background thread, so that training can continue while
+    the checkpoint is serialized. The checkpoint is first copied to CPU memory on the main thread, to ensure that the
+    saved weights are not modified by subsequent training steps. At most one checkpoint is written at any point in
+    time. All pending writes are finished when training ends.
+    """
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending_save: Optional[Future] = None
+        self._pending_save_path: Optional[str] = None
+
+    def _save_model(self, filepath: str, trainer: Trainer, pl_module: LightningModule) -> None:
+        trainer.dev_debugger.track_checkpointing_history(filepath)
+        checkpoint = trainer.checkpoint_connector.dump_checkpoint(self.save_weights_only)
+        if not trainer.is_global_zero:
+            return
+        self._fs.makedirs(os.path.dirname(filepath), exist_ok=True)
+        if trainer.training_type_plugin:
+            checkpoint = trainer.training_type_plugin.on_save(checkpoint)
+        checkpoint = apply_to_collection(checkpoint, torch.Tensor, lambda t: t.detach().to("cpu", copy=True))
+        self.wait_for_pending_save()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_save = self._executor.submit(_save_checkpoint_to_file, checkpoint, filepath)
+        self._pending_save_path = filepath
+
+    def _del_model(self, filepath: str) -> None:
+        # Only wait if the file to delete is still being written. Deleting any other checkpoint file can happen while
+        # the most recent checkpoint is written in the background.
+        if filepath == self._pending_save_path:
+            self.wait_for_pending_save()
+        super()._del_model(filepath)
+
+    def wait_for_pending_save(self) -> None:
+        """
+        Blocks until the most recent checkpoint has been written to disk. Any exception that occurred while writing
+        the checkpoint is raised here.
+        """
+        if self._pending_save is not None:
+            pending_save = self._pending_save
+            self._pending_save = None
+            self._pending_save_path = None
+            pending_save.result()
+
+    def on_train_end(self, trainer: Trainer, pl_module: LightningModule) -> None:
+        self.wait_for_pending_save()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def _save_checkpoint_to_file(checkpoint: Dict[str, Any], filepath: str) -> None:
+    """
+    Writes a checkpoint dictionary to disk, in the same way as the Lightning trainer does.
+    """
+    try:
+        atomic_save(checkpoint, filepath)
+    except AttributeError as err:
+        if LightningModule.CHECKPOINT_HYPER_PARAMS_KEY in checkpoint:
+            del checkpoint[LightningModule.CHECKPOINT_HYPER_PARAMS_KEY]
+        logging.warning(f"Hyperparameters dropped from checkpoint. An attribute is not picklable: {err}")
+        atomic_save(checkpoint, filepath)
+
+
+class InnerEyeRecoveryCheckpointCallback(InnerEyeModelCheckpoint):
     """
     This callback is used to save recovery checkpoints.
     In particular, it makes sure we are logging "epoch", this is needed to the last k
@@ -91,7 +193,7 @@ class InnerEyeRecoveryCheckpointCallback(ModelCheckpoint):
     """
 
     def __init__(self, container: LightningContainer):
-        super().__init__(dirpath=str(container.checkpoint_folder),
+        super().__init__(dirpath=os.fspath(container.checkpoint_folder),
                          monitor="epoch",
                          filename=RECOVERY_CHECKPOINT_FILE_NAME + "_{epoch}",
                          period=container.recovery_checkpoint_save_interval,
@@ -102,6 +204,28 @@ class InnerEyeRecoveryCheckpointCallback(ModelCheckpoint):
         pl_module.log(name="epoch", value=trainer.current_epoch)
 
 
+def get_trainer_precision(container: LightningContainer, num_gpus: int) -> Union[int, str]:
+    """
+    Gets the value for the precision argument of the Lightning trainer. Use 32bit precision when running on CPU.
+    Otherwise, make it depend on the use_bfloat16 and use_mixed_precision flags. bfloat16 does not need gradient
+    scaling, and hence takes precedence over float16 mixed precision.
+    :param container: The container with the model settings.
+    :param num_gpus: The number of GPUs per node that are used for training.
+    :return: The precision that should be passed to the trainer.
+    """
+    if num_gpus == 0:
+        return 32
+    if container.use_bfloat16:
+        if LooseVersion(pytorch_lightning.__version__) < LooseVersion("1.5.0"):
+            raise ValueError(f"Training with bfloat16 requires PyTorch Lightning 1.5 or newer, but the installed "
+                             f"version is {pytorch_lightning.__version__}. Set use_bfloat16 to False, or upgrade "
+                             f"PyTorch Lightning.")
+        return "bf16"
+    if container.use_mixed_precision:
+        return 16
+    return 32
+
+
 def create_lightning_trainer(container: LightningContainer,
                              resume_from_checkpoint: Optional[Path] = None,
                              num_nodes: int = 1,
@@ -117,15 +241,20 @@ def create_lightning_trainer(container: LightningContainer,
     :param kwargs: Any additional keyowrd arguments will be passed to the constructor of Trainer.
     :return: A tuple [Trainer object, diagnostic logger]
     """
+    # Convert all paths to strings once, they are used by several of the objects created below.
+    checkpoint_folder = os.fspath(container.checkpoint_folder)
+    outputs_folder = os.fspath(container.outputs_folder)
+    logs_folder = os.fspath(container.logs_folder)
+    resume_from = os.fspath(resume_from_checkpoint) if resume_from_checkpoint else None
     # For now, stick with the legacy behaviour of always saving only the last epoch checkpoint. For large segmentation
     # models, this still appears to be the best way of choosing them because validation loss on the relatively small
     # training patches is not stable enough. Going by the validation loss somehow works for the Prostate model, but
     # not for the HeadAndNeck model.
-    best_checkpoint_callback = ModelCheckpoint(dirpath=str(container.checkpoint_folder),
-                                               # filename=BEST_CHECKPOINT_FILE_NAME,
-                                               # monitor=f"{VALIDATION_PREFIX}{MetricType.LOSS.value}",
-                                               # save_top_k=1,
-                                               save_last=True)
+    best_checkpoint_callback = InnerEyeModelCheckpoint(dirpath=checkpoint_folder,
+                                                       # filename=BEST_CHECKPOINT_FILE_NAME,
+                                                       # monitor=f"{VALIDATION_PREFIX}{MetricType.LOSS.value}",
+                                                       # save_top_k=1,
+                                                       save_last=True)
 
     # Recovery checkpoints: {epoch} will turn into a string like "epoch=1"
     # Store 1 recovery checkpoint every recovery_checkpoint_save_interval epochs, keep the last
@@ -135,26 +264,27 @@ def create_lightning_trainer(container: LightningContainer,
     num_gpus = container.num_gpus_per_node
     effective_num_gpus = num_gpus * num_nodes
     # Accelerator should be "ddp" when running large models in AzureML (when using DDP_spawn, we get out of GPU memory).
-    # For unit tests, only "ddp_spawn" works
-    accelerator = "ddp" if effective_num_gpus > 1 else None
-    if effective_num_gpus > 1:
+    # For unit tests, only "ddp_spawn" works. Set "ddp" explicitly, rather than letting Lightning choose, because
+    # Lightning can otherwise fall back to "ddp_spawn" on a single node.
+    use_ddp = effective_num_gpus > 1
+    accelerator: Optional[str] = None
+    plugins: List[Any] = []
+    if use_ddp:
+        accelerator = "ddp"
         # Initialize the DDP plugin with find_unused_parameters=False by default. If True (default), it prints out
         # lengthy warnings about the performance impact of find_unused_parameters
-        plugins = [InnerEyeDDPPlugin(num_nodes=num_nodes, sync_batchnorm=True,
-                                     find_unused_parameters=container.pl_find_unused_parameters)]
-    else:
-        plugins = []
+        plugins.append(InnerEyeDDPPlugin(num_nodes=num_nodes, sync_batchnorm=True,
+                                         find_unused_parameters=container.pl_find_unused_parameters))
     logging.info(f"Using {num_gpus} GPUs per node with accelerator '{accelerator}'")
-    tensorboard_logger = TensorBoardLogger(save_dir=str(container.logs_folder), name="Lightning", version="")
-    loggers = [tensorboard_logger, AzureMLLogger()]
+    tensorboard_logger = TensorBoardLogger(save_dir=logs_folder, name="Lightning", version="")
+    loggers = [tensorboard_logger, AsyncAzureMLLogger()]
     storing_logger: Optional[StoringLogger]
     if isinstance(container, InnerEyeContainer):
         storing_logger = StoringLogger()
         loggers.append(storing_logger)
     else:
         storing_logger = None
-    # Use 32bit precision when running on CPU. Otherwise, make it depend on use_mixed_precision flag.
-    precision = 32 if num_gpus == 0 else 16 if container.use_mixed_precision else 32
+    precision = get_trainer_precision(container, num_gpus)
     # The next two flags control the settings in torch.backends.cudnn.deterministic and torch.backends.cudnn.benchmark
     # https://pytorch.org/docs/stable/notes/randomness.html
     # For the classification models, we observed only a small performance deterioration (increase in 10sec on total
@@ -179,7 +309,7 @@ def create_lightning_trainer(container: LightningContainer,
                      f"To change, modify the pl_progress_bar_refresh_rate field of the container.")
     # Read out additional model-specific args here.
     # We probably want to keep essential ones like numgpu and logging.
-    trainer = Trainer(default_root_dir=str(container.outputs_folder),
+    trainer = Trainer(default_root_dir=outputs_folder,
                       deterministic=deterministic,
                       benchmark=benchmark,
                       accelerator=accelerator,
@@ -191,9 +321,12 @@ def create_lightning_trainer(container: LightningContainer,
                       num_nodes=num_nodes,
                       gpus=num_gpus,
                       precision=precision,
-                      sync_batchnorm=True,
+                      # Synchronizing batchnorm statistics only makes sense (and costs an allreduce) with DDP
+                      sync_batchnorm=use_ddp,
+                      # Ensure that each DDP rank sees a disjoint shard of the data
+                      replace_sampler_ddp=True,
                       terminate_on_nan=container.detect_anomaly,
-                      resume_from_checkpoint=str(resume_from_checkpoint) if resume_from_checkpoint else None,
+                      resume_from_checkpoint=resume_from,
                       plugins=plugins,
                       **kwargs)
     return trainer, storing_logger
@@ -276,8 +409,12 @@ def model_train(checkpoint_handler: CheckpointHandler,
     # When training models that are not built-in InnerEye models, we have no guarantee that they write
     # files to the right folder. Best guess is to change the current working directory to where files should go.
     with change_working_directory(container.outputs_folder):
-        trainer.fit(lightning_model, datamodule=data_module)
-        trainer.logger.close()  # type: ignore
+        try:
+            trainer.fit(lightning_model, datamodule=data_module)
+        finally:
+            # Closing the loggers also writes out any metrics that are still queued up for AzureML, and needs to
+            # happen also if training fails.
+            trainer.logger.close()  # type: ignore
     world_size = getattr(trainer, "world_size", 0)
     is_azureml_run = not is_offline_run_context(RUN_CONTEXT)
     # Per-subject model outputs for regression models are written per rank, and need to be aggregated here.
@@ -305,10 +442,7 @@ def model_train(checkpoint_handler: CheckpointHandler,
             # In a DDP run on the local box, all ranks will write to local disk, hence no download needed.
             # In a multi-node DDP, each rank would upload to AzureML, and rank 0 will now download all results and
             # concatenate
-            for rank in range(world_size):
-                for mode in [ModelExecutionMode.TRAIN, ModelExecutionMode.VAL]:
-                    file = mode.value + "/" + get_subject_output_file_per_rank(rank)
-                    RUN_CONTEXT.download_file(name=TEMP_PREFIX + file, output_file_path=container.outputs_folder / file)
+            download_output_files_from_all_ranks(world_size, container.outputs_folder)
         # Concatenate all temporary file per execution mode
         aggregate_and_create_subject_metrics_file(container.outputs_folder)
 
@@ -344,15 +478,22 @@ def aggregate_and_create_subject_metrics_file(outputs_folder: Path) -> None:
     for mode in [ModelExecutionMode.TRAIN, ModelExecutionMode.VAL]:
         temp_files = sorted((outputs_folder / mode.value).rglob(SUBJECT_OUTPUT_PER_RANK_PREFIX + "*"))
         result_file = outputs_folder / mode.value / SUBJECT_METRICS_FILE_NAME
-        with result_file.open("a") as f:
+        # Copy the files as raw bytes, to avoid decoding and splitting them into lines.
+        with result_file.open("wb") as f:
+            # Copy the first file as-is, including the first line with the column headers.
+            # For all files but the first one, cut off the header line.
             for i, file in enumerate(temp_files):
-                temp_file_contents = file.read_text()
-                if i == 0:
-                    # Copy the first file as-is, including the first line with the column headers
-                    f.write(temp_file_contents)
-                else:
-                    # For all files but the first one, cut off the header line.
-                    f.write("\n".join(temp_file_contents.splitlines()[1:]))
+                with file.open("rb") as temp_file:
+                    if i > 0:
+                        temp_file.readline()
+                    start = temp_file.tell()
+                    shutil.copyfileobj(temp_file, f, COPY_BUFFER_SIZE)
+                    # If the file does not end with a newline, add one, so that the next file starts on a new line.
+                    # This only looks at the last byte, the line separators in the file itself are kept as-is.
+                    if temp_file.tell() > start:
+                        temp_file.seek(-1, os.SEEK_END)
+                        if temp_file.read(1) != b"\n":
+                            f.write(b"\n")
 
 
 class InnerEyeDDPPlugin(DDPPlugin):
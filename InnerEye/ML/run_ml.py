@@ -451,9 +451,14 @@ class MLRunner:
             # When training models that are not built-in InnerEye models, we have no guarantee that they write
             # files to the right folder. Best guess is to change the current working directory to where files should go.
             with change_working_directory(self.container.outputs_folder):
-                trainer.test(self.container.model,
-                             test_dataloaders=self.container.get_data_module().test_dataloader(),
-                             ckpt_path=str(checkpoint_paths[0]))
+                try:
+                    trainer.test(self.container.model,
+                                 test_dataloaders=self.container.get_data_module().test_dataloader(),
+                                 ckpt_path=str(checkpoint_paths[0]))
+                finally:
+                    # Lightning only finalizes the loggers at the end of training, not after testing. Close them
+                    # here to write out any metrics that are still queued up for AzureML.
+                    trainer.logger.close()  # type: ignore
         else:
             logging.warning("None of the suitable test methods is overridden. Skipping inference completely.")
 
@@ -2,6 +2,7 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+import hashlib
 import logging
 from pathlib import Path
 from typing import Optional
@@ -23,6 +24,8 @@ from InnerEye.ML.utils import io_util
 from InnerEye.ML.utils.image_util import get_unit_image_header
 
 PATCH_SAMPLING_FOLDER = "patch_sampling"
+# The suffix of the marker file that indicates that patch sampling visualizations have been completed.
+PATCH_SAMPLING_DONE_SUFFIX = ".done"
 
 
 class CheckPatchSamplingConfig(GenericConfig):
@@ -107,19 +110,43 @@ def visualize_random_crops(sample: Sample,
     return heatmap
 
 
+def get_patch_sampling_hash(config: SegmentationModelBase) -> str:
+    """
+    Computes a hash value of all config fields that affect the patch sampling visualizations.
+    :param config: The model configuration.
+    :return: A hex string with the hash value.
+    """
+    fields = [config.crop_size,
+              config.class_weights,
+              config.show_patch_sampling,
+              config.get_effective_random_seed(),
+              config.azure_dataset_id,
+              config.local_dataset,
+              config.dataset_csv]
+    return hashlib.sha256(repr(fields).encode("utf-8")).hexdigest()
+
+
 def visualize_random_crops_for_dataset(config: SegmentationModelBase, output_folder: Optional[Path] = None) -> None:
     """
     For segmentation models only: This function generates visualizations of the effect of sampling random patches
     for training. Visualizations are stored in both Nifti format, and as 3 PNG thumbnail files, in the output folder.
+    If the output folder already contains visualizations for the same dataset and sampling settings, they are not
+    created again.
     :param config: The model configuration.
     :param output_folder: The folder in which the visualizations should be written. If not provided, use a subfolder
     "patch_sampling" in the model's default output folder
     """
+    output_folder = output_folder or config.outputs_folder / PATCH_SAMPLING_FOLDER
+    done_file = output_folder / f"{get_patch_sampling_hash(config)}{PATCH_SAMPLING_DONE_SUFFIX}"
+    if done_file.is_file():
+        logging.info(f"Skipping patch sampling visualization, results are already available in {output_folder}")
+        return
     dataset_splits = config.get_dataset_splits()
     # Load a sample using the full image data loader
     full_image_dataset = FullImageDataset(config, dataset_splits.train)
-    output_folder = output_folder or config.outputs_folder / PATCH_SAMPLING_FOLDER
     count = min(config.show_patch_sampling, len(full_image_dataset))
     for sample_index in range(count):
         sample = full_image_dataset.get_samples_at_index(index=sample_index)[0]
         visualize_random_crops(sample, config, output_folder=output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    done_file.touch()
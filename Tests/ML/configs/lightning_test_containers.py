@@ -135,15 +135,17 @@ class DummyRegression(DummyRegressionPlainLightning, InnerEyeInference):
         self.dataset_split = dataset_split
         Path(f"on_inference_start_{self.dataset_split.value}.txt").touch()
         self.mse = MeanSquaredError()
+        self.inference_step_lines: List[str] = []
 
     def inference_step(self, item: Tuple[Tensor, Tensor], batch_idx: int, model_output: torch.Tensor) -> None:
         input, target = item
         prediction = self.forward(input)
         self.mse(prediction, target)
-        with Path(f"inference_step_{self.dataset_split.value}.txt").open(mode="a") as f:
-            f.write(f"{prediction.item()},{target.item()}\n")
+        self.inference_step_lines.append(f"{prediction.item()},{target.item()}\n")
 
     def on_inference_epoch_end(self) -> None:
+        # Write all predictions in one go, rather than opening the file in each inference step
+        Path(f"inference_step_{self.dataset_split.value}.txt").write_text("".join(self.inference_step_lines))
         Path(f"on_inference_end_{self.dataset_split.value}.txt").touch()
         self.inference_mse[self.dataset_split] = self.mse.compute().item()
         self.mse.reset()
@@ -158,32 +160,35 @@ class DummyRegression(DummyRegressionPlainLightning, InnerEyeInference):
 class FixedDataset(Dataset):
     def __init__(self, inputs_and_targets: List[Tuple[Any, Any]]):
         super().__init__()
-        self.inputs_and_targets = inputs_and_targets
+        # Convert all inputs and targets to tensors upfront, so that __getitem__ only needs to index into them.
+        self.inputs = torch.tensor([[float(input)] for input, _ in inputs_and_targets], dtype=torch.float32)
+        self.targets = torch.tensor([[float(target)] for _, target in inputs_and_targets], dtype=torch.float32)
 
     def __len__(self) -> int:
-        return len(self.inputs_and_targets)
+        return len(self.inputs)
 
     def __getitem__(self, item: int) -> Tuple[Tensor, Tensor]:
-        input = torch.tensor([float(self.inputs_and_targets[item][0])])
-        target = torch.tensor([float(self.inputs_and_targets[item][1])])
-        return input, target
+        return self.inputs[item], self.targets[item]
 
 
 class FixedRegressionData(LightningDataModule):
     def __init__(self) -> None:
         super().__init__()
-        self.train_data = [(i, i) for i in range(1, 20, 3)]
-        self.val_data = [(i, i) for i in range(2, 20, 3)]
-        self.test_data = [(i, i) for i in range(3, 20, 3)]
+        self.train_data = FixedDataset([(i, i) for i in range(1, 20, 3)])
+        self.val_data = FixedDataset([(i, i) for i in range(2, 20, 3)])
+        self.test_data = FixedDataset([(i, i) for i in range(3, 20, 3)])
+        # Use page-locked memory when training on GPU, for faster host to device copies. The datasets are tiny and
+        # held in memory already, hence data loading runs in the main process, without worker processes.
+        self.pin_memory = torch.cuda.is_available()
 
     def train_dataloader(self, *args: Any, **kwargs: Any) -> DataLoader:
-        return DataLoader(FixedDataset(self.train_data))  # type: ignore
+        return DataLoader(self.train_data, pin_memory=self.pin_memory)  # type: ignore
 
     def val_dataloader(self, *args: Any, **kwargs: Any) -> DataLoader:
-        return DataLoader(FixedDataset(self.val_data))  # type: ignore
+        return DataLoader(self.val_data, pin_memory=self.pin_memory)  # type: ignore
 
     def test_dataloader(self, *args: Any, **kwargs: Any) -> DataLoader:
-        return DataLoader(FixedDataset(self.test_data))  # type: ignore
+        return DataLoader(self.test_data, pin_memory=self.pin_memory)  # type: ignore
 
 
 class DummyContainerWithModel(LightningContainer):
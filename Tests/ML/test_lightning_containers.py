@@ -4,18 +4,20 @@
 #  ------------------------------------------------------------------------------------------
 from io import StringIO
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List
 from unittest import mock
 
 import pandas as pd
 import pytest
-from pytorch_lightning import LightningModule
+from pytorch_lightning import LightningModule, Trainer
 
+from InnerEye.Common.metrics_constants import LoggingColumns
 from InnerEye.Common.output_directories import OutputFolderForTests
 from InnerEye.ML.common import ModelExecutionMode
 from InnerEye.ML.deep_learning_config import ARGS_TXT, DatasetParams, WorkflowParams
 from InnerEye.ML.lightning_base import InnerEyeContainer
 from InnerEye.ML.lightning_container import LightningContainer
+from InnerEye.ML.lightning_loggers import AsyncAzureMLLogger
 from InnerEye.ML.model_config_base import ModelConfigBase
 from InnerEye.ML.run_ml import MLRunner
 from Tests.ML.configs.DummyModel import DummyModel
@@ -280,3 +282,59 @@ def test_container_hooks(test_output_dirs: OutputFolderForTests) -> None:
     # only check that they have all been called.
     for file in ["global_rank_zero.txt", "local_rank_zero.txt", "all_ranks.txt"]:
         assert (runner.container.outputs_folder / file).is_file(), f"Missing file: {file}"
+
+
+def test_run_inference_for_lightning_models_logs_metrics(test_output_dirs: OutputFolderForTests) -> None:
+    """
+    Test if all metrics that are logged during Lightning's test procedure are written to AzureML, even though
+    Lightning does not finalize the loggers after testing.
+    """
+    container = DummyContainerWithPlainLightning()
+    container.local_dataset = test_output_dirs.root_dir
+    runner = MLRunner(model_config=None, container=container)
+    runner.setup()
+    checkpoint_path = test_output_dirs.root_dir / "checkpoint.ckpt"
+    trainer = Trainer()
+    trainer.model = runner.container.model
+    trainer.save_checkpoint(checkpoint_path)
+    logged_metrics: List[Dict[str, Any]] = []
+    log_metrics = AsyncAzureMLLogger.log_metrics
+
+    def record_and_log_metrics(self: AsyncAzureMLLogger, metrics: Dict[str, Any], step: Any = None) -> None:
+        logged_metrics.append(dict(metrics))
+        log_metrics(self, metrics, step)
+
+    with mock.patch("InnerEye.ML.lightning_loggers.RUN_CONTEXT") as run_context:
+        with mock.patch("InnerEye.ML.lightning_loggers.is_offline_run_context", return_value=False):
+            with mock.patch.object(AsyncAzureMLLogger, "log_metrics", record_and_log_metrics):
+                runner.run_inference_for_lightning_models([checkpoint_path])
+    assert (runner.container.outputs_folder / "test_step.txt").is_file()
+    assert len(logged_metrics) > 0
+    assert run_context.log.call_args_list == [mock.call(key, value)
+                                              for metrics in logged_metrics
+                                              for key, value in metrics.items()]
+
+
+@pytest.mark.parametrize("print_model_summary", [True, False])
+def test_before_training_model_summary(test_output_dirs: OutputFolderForTests, print_model_summary: bool) -> None:
+    """
+    Test if the model summary is only generated if the print_model_summary flag is set, and that the number of
+    trainable parameters is logged in either case.
+    """
+    config = DummyModel()
+    config.set_output_to(test_output_dirs.root_dir)
+    config.print_model_summary = print_model_summary
+    container = InnerEyeContainer(config)
+    container.create_lightning_module_and_store()
+    with mock.patch.object(config, "write_dataset_files"):
+        with mock.patch("InnerEye.ML.lightning_base.visualize_random_crops_for_dataset"):
+            with mock.patch("InnerEye.ML.lightning_base.generate_and_print_model_summary") as summary_mock:
+                with mock.patch("InnerEye.ML.lightning_base.RUN_CONTEXT") as run_context:
+                    container.before_training_on_global_rank_zero()
+    if print_model_summary:
+        summary_mock.assert_called_once()
+        run_context.log.assert_not_called()
+    else:
+        summary_mock.assert_not_called()
+        num_parameters = container.model.model.get_number_trainable_parameters()  # type: ignore
+        run_context.log.assert_called_once_with(LoggingColumns.NumTrainableParameters, num_parameters)
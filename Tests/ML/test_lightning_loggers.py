@@ -0,0 +1,101 @@
+#  ------------------------------------------------------------------------------------------
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
+#  ------------------------------------------------------------------------------------------
+from unittest import mock
+
+import pytest
+
+from InnerEye.Common.metrics_constants import TRAIN_PREFIX, VALIDATION_PREFIX
+from InnerEye.ML.lightning_loggers import AsyncAzureMLLogger, INITIAL_EPOCH_CAPACITY, StoringLogger
+
+
+def test_storing_logger() -> None:
+    """
+    Test if the StoringLogger correctly stores and retrieves metrics, also when the number of epochs exceeds the
+    initially allocated capacity.
+    """
+    logger = StoringLogger()
+    first_epoch = 3
+    num_epochs = 2 * INITIAL_EPOCH_CAPACITY + 1
+    epochs = list(range(first_epoch, first_epoch + num_epochs))
+    for epoch in epochs:
+        logger.log_metrics({"epoch": epoch, TRAIN_PREFIX + "loss": float(epoch)})
+        logger.log_metrics({"epoch": epoch, VALIDATION_PREFIX + "loss": 2.0 * epoch, VALIDATION_PREFIX + "foo": 1.0})
+    assert list(logger.epochs) == epochs
+    assert logger.get_train_metric("loss") == [float(epoch) for epoch in epochs]
+    assert logger.get_val_metric("loss") == [2.0 * epoch for epoch in epochs]
+    assert logger.train_results_per_epoch()[0] == {"loss": first_epoch}
+    assert logger.val_results_per_epoch()[-1] == {"loss": 2.0 * epochs[-1], "foo": 1.0}
+    assert logger.results[first_epoch] == {TRAIN_PREFIX + "loss": first_epoch,
+                                           VALIDATION_PREFIX + "loss": 2.0 * first_epoch,
+                                           VALIDATION_PREFIX + "foo": 1.0}
+    with pytest.raises(KeyError):
+        logger.extract_by_prefix(epoch=0)
+    with pytest.raises(ValueError) as ex:
+        logger.log_metrics({"epoch": first_epoch, VALIDATION_PREFIX + "foo": 1.0})
+    assert "same name twice" in str(ex)
+
+
+def test_storing_logger_missing_metric() -> None:
+    """
+    Test if the StoringLogger raises an error when reading out a metric that is not present in all epochs.
+    """
+    logger = StoringLogger()
+    logger.log_metrics({"epoch": 0, TRAIN_PREFIX + "loss": 1.0})
+    logger.log_metrics({"epoch": 1, TRAIN_PREFIX + "other": 1.0})
+    assert logger.extract_by_prefix(epoch=1, prefix_filter=TRAIN_PREFIX) == {"other": 1.0}
+    with pytest.raises(KeyError):
+        logger.get_train_metric("loss")
+
+
+def test_async_azureml_logger() -> None:
+    """
+    Test if the AsyncAzureMLLogger writes all metrics to the AzureML run, in the order in which they were logged.
+    """
+    with mock.patch("InnerEye.ML.lightning_loggers.RUN_CONTEXT") as run_context:
+        logger = AsyncAzureMLLogger(max_queue_size=2)
+        logger.is_azureml_run = True
+        for step in range(10):
+            logger.log_metrics({"loss": float(step), "step": step})
+        logger.close()
+        assert run_context.log.call_args_list == [mock.call(key, value)
+                                                  for step in range(10)
+                                                  for key, value in [("loss", float(step)), ("step", step)]]
+        # Logging after closing should start a new background thread
+        logger.log_metrics({"loss": 1.0})
+        logger.close()
+        assert run_context.log.call_count == 21
+
+
+def test_async_azureml_logger_offline() -> None:
+    """
+    Test if the AsyncAzureMLLogger does not log anything when running outside of AzureML.
+    """
+    with mock.patch("InnerEye.ML.lightning_loggers.RUN_CONTEXT") as run_context:
+        logger = AsyncAzureMLLogger()
+        logger.is_azureml_run = False
+        logger.log_metrics({"loss": 1.0})
+        logger.close()
+        run_context.log.assert_not_called()
+
+
+def test_async_azureml_logger_error() -> None:
+    """
+    Test if the AsyncAzureMLLogger raises errors from the background thread on the main thread, and can be used
+    again afterwards.
+    """
+    with mock.patch("InnerEye.ML.lightning_loggers.RUN_CONTEXT") as run_context:
+        run_context.log.side_effect = ValueError("logging failed")
+        logger = AsyncAzureMLLogger(max_queue_size=2)
+        logger.is_azureml_run = True
+        logger.log_metrics({"loss": 1.0, "step": 1})
+        with pytest.raises(ValueError) as ex:
+            logger.close()
+        assert "logging failed" in str(ex.value)
+        # Logging stops at the first failure
+        assert run_context.log.call_count == 1
+        run_context.log.side_effect = None
+        logger.log_metrics({"loss": 1.0})
+        logger.close()
+        assert run_context.log.call_count == 2
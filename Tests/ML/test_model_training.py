@@ -5,15 +5,20 @@
 import logging
 import os
 import shutil
+import threading
 from pathlib import Path
 from typing import Any, Dict, List
+from unittest import mock
 
 import h5py
 import numpy as np
 import pandas as pd
 import pytest
+import pytorch_lightning
+import torch
 from torch.utils.data import DataLoader
 
+from InnerEye.Azure.azure_runner import ENV_LOCAL_RANK, ENV_NODE_RANK
 from InnerEye.Common import fixed_paths
 from InnerEye.Common.common_util import SUBJECT_METRICS_FILE_NAME, is_windows, logging_to_stdout
 from InnerEye.Common.fixed_paths_for_tests import full_ml_test_data_path
@@ -27,13 +32,17 @@ from InnerEye.ML.configs.classification.DummyClassification import DummyClassifi
 from InnerEye.ML.dataset.sample import CroppedSample
 from InnerEye.ML.deep_learning_config import DeepLearningConfig
 from InnerEye.ML.lightning_loggers import StoringLogger
-from InnerEye.ML.model_training import aggregate_and_create_subject_metrics_file
+from InnerEye.ML.lightning_models import get_subject_output_file_per_rank
+from InnerEye.ML.model_training import InnerEyeModelCheckpoint, TEMP_PREFIX, \
+    aggregate_and_create_subject_metrics_file, create_lightning_trainer, download_output_files_from_all_ranks, \
+    get_trainer_precision, is_global_rank_zero, is_local_rank_zero
 from InnerEye.ML.models.losses.mixture import MixtureLoss
 from InnerEye.ML.utils.io_util import load_nifti_image
 from InnerEye.ML.utils.model_util import create_segmentation_loss_function
 from InnerEye.ML.utils.run_recovery import RunRecovery
 from InnerEye.ML.visualizers.patch_sampling import PATCH_SAMPLING_FOLDER
 from Tests.ML.configs.DummyModel import DummyModel
+from Tests.ML.configs.lightning_test_containers import DummyContainerWithModel
 from Tests.ML.util import get_default_checkpoint_handler, machine_has_gpu, model_train_unittest
 
 config_path = full_ml_test_data_path()
@@ -355,7 +364,208 @@ def test_aggregate_and_create_subject_metrics_file(test_output_dirs: OutputFolde
     outputs_folder = test_output_dirs.root_dir / "outputs"
     shutil.copytree(str(full_ml_test_data_path("test_aggregate_metrics_classification")), str(outputs_folder))
     aggregate_and_create_subject_metrics_file(outputs_folder)
+    # Running the aggregation a second time should overwrite the results, rather than appending to them.
+    aggregate_and_create_subject_metrics_file(outputs_folder)
     for mode in [ModelExecutionMode.TRAIN.value, ModelExecutionMode.VAL.value]:
         written_lines = pd.read_csv(outputs_folder / mode / SUBJECT_METRICS_FILE_NAME)
         expected_lines = pd.read_csv(outputs_folder / mode / "expected_metrics.csv")
         assert written_lines.equals(expected_lines)
+
+
+def test_aggregate_subject_metrics_without_trailing_newline(test_output_dirs: OutputFolderForTests) -> None:
+    """
+    Test that per-rank files are concatenated correctly if they do not end with a newline.
+    """
+    outputs_folder = test_output_dirs.root_dir
+    for mode in [ModelExecutionMode.TRAIN, ModelExecutionMode.VAL]:
+        folder = outputs_folder / mode.value
+        folder.mkdir()
+        for rank in range(3):
+            (folder / get_subject_output_file_per_rank(rank)).write_bytes(f"header\nrank{rank}".encode("utf-8"))
+    aggregate_and_create_subject_metrics_file(outputs_folder)
+    for mode in [ModelExecutionMode.TRAIN, ModelExecutionMode.VAL]:
+        actual = (outputs_folder / mode.value / SUBJECT_METRICS_FILE_NAME).read_bytes()
+        assert actual == b"header\nrank0\nrank1\nrank2\n"
+
+
+def test_is_rank_zero() -> None:
+    """
+    Test if rank zero is correctly detected from environment variables, also when the node rank is only set after
+    the first call (as done in set_environment_variables_for_multi_node).
+    """
+    with mock.patch.dict(os.environ, {}, clear=True):
+        assert is_local_rank_zero()
+        assert is_global_rank_zero()
+        os.environ[ENV_NODE_RANK] = "1"
+        assert is_local_rank_zero()
+        assert not is_global_rank_zero()
+        os.environ[ENV_NODE_RANK] = "0"
+        os.environ[ENV_LOCAL_RANK] = "1"
+        assert not is_local_rank_zero()
+        assert not is_global_rank_zero()
+
+
+def _create_mock_trainer() -> mock.MagicMock:
+    """
+    Creates a mock trainer that returns a small checkpoint dictionary, as required by InnerEyeModelCheckpoint.
+    """
+    trainer = mock.MagicMock()
+    trainer.is_global_zero = True
+    trainer.checkpoint_connector.dump_checkpoint.return_value = {"state_dict": {"weight": torch.ones(2)}}
+    trainer.training_type_plugin.on_save.side_effect = lambda checkpoint: checkpoint
+    return trainer
+
+
+def test_checkpoint_written_before_train_end(test_output_dirs: OutputFolderForTests) -> None:
+    """
+    Test that checkpoints that are written on a background thread are complete when on_train_end returns.
+    """
+    callback = InnerEyeModelCheckpoint(dirpath=str(test_output_dirs.root_dir))
+    checkpoint_file = test_output_dirs.root_dir / "last.ckpt"
+    callback._save_model(str(checkpoint_file), _create_mock_trainer(), mock.MagicMock())
+    callback.on_train_end(mock.MagicMock(), mock.MagicMock())
+    assert checkpoint_file.is_file()
+    checkpoint = torch.load(checkpoint_file)
+    assert torch.equal(checkpoint["state_dict"]["weight"], torch.ones(2))
+
+
+def test_checkpoint_write_failure(test_output_dirs: OutputFolderForTests) -> None:
+    """
+    Test that an exception raised while writing a checkpoint in the background is raised in wait_for_pending_save.
+    """
+    callback = InnerEyeModelCheckpoint(dirpath=str(test_output_dirs.root_dir))
+    with mock.patch("InnerEye.ML.model_training._save_checkpoint_to_file", side_effect=ValueError("write failed")):
+        callback._save_model(str(test_output_dirs.root_dir / "last.ckpt"), _create_mock_trainer(), mock.MagicMock())
+        with pytest.raises(ValueError) as ex:
+            callback.wait_for_pending_save()
+    assert "write failed" in str(ex.value)
+    # The failure is only raised once.
+    callback.wait_for_pending_save()
+
+
+def test_checkpoint_delete_does_not_wait(test_output_dirs: OutputFolderForTests) -> None:
+    """
+    Test that deleting a checkpoint file does not wait for the write of a different checkpoint file to finish, but
+    waits if the file to delete is still being written.
+    """
+    callback = InnerEyeModelCheckpoint(dirpath=str(test_output_dirs.root_dir))
+    write_can_finish = threading.Event()
+    old_file = test_output_dirs.root_dir / "old.ckpt"
+    old_file.touch()
+    new_file = test_output_dirs.root_dir / "new.ckpt"
+
+    def blocking_save(checkpoint: Dict[str, Any], filepath: str) -> None:
+        write_can_finish.wait(timeout=60)
+        Path(filepath).touch()
+
+    with mock.patch("InnerEye.ML.model_training._save_checkpoint_to_file", side_effect=blocking_save):
+        callback._save_model(str(new_file), _create_mock_trainer(), mock.MagicMock())
+        callback._del_model(str(old_file))
+        assert not old_file.exists()
+        # The write of the new checkpoint is still blocked, hence deleting the old file did not wait for it.
+        assert not new_file.exists()
+        write_can_finish.set()
+        callback._del_model(str(new_file))
+        assert not new_file.exists()
+        callback.on_train_end(mock.MagicMock(), mock.MagicMock())
+
+
+@pytest.mark.parametrize(["num_gpus", "use_mixed_precision", "use_bfloat16", "expected"],
+                         [(0, False, False, 32),
+                          (0, True, False, 32),
+                          (0, True, True, 32),
+                          (1, False, False, 32),
+                          (1, True, False, 16),
+                          (1, False, True, "bf16"),
+                          (1, True, True, "bf16")])
+def test_get_trainer_precision(num_gpus: int, use_mixed_precision: bool, use_bfloat16: bool, expected: Any) -> None:
+    """
+    Test that the trainer precision is chosen correctly from the container flags and the number of GPUs.
+    """
+    container = mock.MagicMock(use_mixed_precision=use_mixed_precision, use_bfloat16=use_bfloat16)
+    with mock.patch.object(pytorch_lightning, "__version__", "1.5.0"):
+        assert get_trainer_precision(container, num_gpus) == expected
+
+
+def test_get_trainer_precision_bfloat16_old_lightning() -> None:
+    """
+    Test that requesting bfloat16 with a version of Lightning that does not support it raises a clear error.
+    """
+    container = mock.MagicMock(use_mixed_precision=False, use_bfloat16=True)
+    with mock.patch.object(pytorch_lightning, "__version__", "1.2.8"):
+        with pytest.raises(ValueError) as ex:
+            get_trainer_precision(container, num_gpus=1)
+    assert "PyTorch Lightning 1.5" in str(ex.value)
+
+
+@pytest.mark.parametrize(["num_gpus", "num_nodes", "expected_accelerator", "expected_ddp"],
+                         [(0, 1, None, False),
+                          (1, 1, None, False),
+                          (2, 1, "ddp", True),
+                          (0, 2, None, False),
+                          (1, 2, "ddp", True)])
+def test_create_lightning_trainer_accelerator(test_output_dirs: OutputFolderForTests,
+                                              num_gpus: int,
+                                              num_nodes: int,
+                                              expected_accelerator: Any,
+                                              expected_ddp: bool) -> None:
+    """
+    Test that the accelerator, the DDP plugin and the batchnorm synchronization are chosen correctly from the number
+    of GPUs and nodes.
+    """
+    container = DummyContainerWithModel()
+    container.set_output_to(test_output_dirs.root_dir)
+    with mock.patch.object(DummyContainerWithModel, "num_gpus_per_node", new_callable=mock.PropertyMock,
+                           return_value=num_gpus):
+        with mock.patch("InnerEye.ML.model_training.Trainer") as trainer_mock:
+            with mock.patch("InnerEye.ML.model_training.InnerEyeDDPPlugin") as ddp_plugin_mock:
+                create_lightning_trainer(container, num_nodes=num_nodes)
+    trainer_mock.assert_called_once()
+    trainer_args = trainer_mock.call_args[1]
+    assert trainer_args["accelerator"] == expected_accelerator
+    assert trainer_args["sync_batchnorm"] == expected_ddp
+    assert trainer_args["replace_sampler_ddp"]
+    assert trainer_args["gpus"] == num_gpus
+    assert trainer_args["num_nodes"] == num_nodes
+    if expected_ddp:
+        ddp_plugin_mock.assert_called_once()
+        assert ddp_plugin_mock.call_args[1]["num_nodes"] == num_nodes
+        assert trainer_args["plugins"] == [ddp_plugin_mock.return_value]
+    else:
+        ddp_plugin_mock.assert_not_called()
+        assert trainer_args["plugins"] == []
+
+
+def test_download_output_files_from_all_ranks(test_output_dirs: OutputFolderForTests) -> None:
+    """
+    Test that the per-rank subject output files are downloaded for all ranks and for training and validation.
+    """
+    world_size = 3
+    outputs_folder = test_output_dirs.root_dir
+    with mock.patch("InnerEye.ML.model_training.RUN_CONTEXT") as run_context:
+        download_output_files_from_all_ranks(world_size, outputs_folder)
+    expected_files = [f"{mode.value}/{get_subject_output_file_per_rank(rank)}"
+                      for rank in range(world_size)
+                      for mode in [ModelExecutionMode.TRAIN, ModelExecutionMode.VAL]]
+    assert run_context.download_file.call_count == len(expected_files)
+    # Downloads run in parallel, hence the order of the calls is not fixed.
+    actual_calls = {(call[1]["name"], call[1]["output_file_path"])
+                    for call in run_context.download_file.call_args_list}
+    assert actual_calls == {(TEMP_PREFIX + file, outputs_folder / file) for file in expected_files}
+
+
+def test_download_output_files_from_all_ranks_fails(test_output_dirs: OutputFolderForTests) -> None:
+    """
+    Test that an exception in any of the parallel downloads is raised.
+    """
+    failing_file = TEMP_PREFIX + f"{ModelExecutionMode.VAL.value}/{get_subject_output_file_per_rank(1)}"
+
+    def download_file(name: str, output_file_path: Path) -> None:
+        if name == failing_file:
+            raise ValueError(f"Download failed: {name}")
+
+    with mock.patch("InnerEye.ML.model_training.RUN_CONTEXT") as run_context:
+        run_context.download_file.side_effect = download_file
+        with pytest.raises(ValueError) as ex:
+            download_output_files_from_all_ranks(2, test_output_dirs.root_dir)
+    assert failing_file in str(ex.value)
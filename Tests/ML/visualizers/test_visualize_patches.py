@@ -3,6 +3,7 @@
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
 from pathlib import Path
+from unittest import mock
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -19,7 +20,8 @@ from InnerEye.ML.utils import io_util
 from InnerEye.ML.utils.image_util import get_unit_image_header
 from InnerEye.ML.utils.io_util import load_nifti_image
 from InnerEye.ML.utils.ml_util import set_random_seed
-from InnerEye.ML.visualizers.patch_sampling import visualize_random_crops
+from InnerEye.ML.visualizers.patch_sampling import PATCH_SAMPLING_DONE_SUFFIX, visualize_random_crops, \
+    visualize_random_crops_for_dataset
 from Tests.ML.util import assert_binary_files_match, assert_file_exists
 
 
@@ -176,3 +178,24 @@ def test_show_non_square_images(test_output_dirs: OutputFolderForTests) -> None:
         # To update the stored results, uncomment this line:
         # expected.write_bytes(actual_file.read_bytes())
         assert_binary_files_match(actual_file, expected)
+
+
+def test_visualize_random_crops_for_dataset_is_cached(test_output_dirs: OutputFolderForTests) -> None:
+    """
+    Tests that patch sampling visualizations are only created once for the same settings.
+    """
+    config = SegmentationModelBase(should_validate=False, crop_size=(2, 10, 10))
+    output_folder = Path(test_output_dirs.root_dir)
+    with mock.patch.object(SegmentationModelBase, "get_dataset_splits") as get_dataset_splits:
+        with mock.patch("InnerEye.ML.visualizers.patch_sampling.FullImageDataset") as dataset:
+            dataset.return_value.__len__.return_value = 0
+            visualize_random_crops_for_dataset(config, output_folder=output_folder)
+            assert get_dataset_splits.call_count == 1
+            assert len(list(output_folder.glob("*" + PATCH_SAMPLING_DONE_SUFFIX))) == 1
+            # Calling again with the same settings should not sample patches again
+            visualize_random_crops_for_dataset(config, output_folder=output_folder)
+            assert get_dataset_splits.call_count == 1
+            # Changing a relevant setting should trigger the visualization again
+            config.crop_size = (2, 8, 8)
+            visualize_random_crops_for_dataset(config, output_folder=output_folder)
+            assert get_dataset_splits.call_count == 2
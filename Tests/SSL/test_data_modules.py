@@ -55,6 +55,30 @@ def test_weights_innereye_module() -> None:
     assert images_v1.shape == images_v2.shape == torch.Size([1, 3, 224, 224])
 
 
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_innereye_vision_module_worker_args(num_workers: int) -> None:
+    """
+    Tests if the dataloaders of InnerEyeVisionDataModule keep their workers alive across epochs, and prefetch
+    the configured number of batches.
+    """
+    transforms = get_cxr_ssl_transforms(cxr_augmentation_config,
+                                        return_two_views_per_sample=True)
+    data_module = InnerEyeVisionDataModule(dataset_cls=RSNAKaggleCXR,
+                                           return_index=False,
+                                           train_transforms=transforms[0],
+                                           val_transforms=transforms[1],
+                                           data_dir=str(path_to_test_dataset),
+                                           batch_size=1,
+                                           seed=1,
+                                           num_workers=num_workers,
+                                           prefetch_factor=3)
+    data_module.setup()
+    for dataloader in [data_module.train_dataloader(), data_module.val_dataloader()]:
+        assert dataloader.num_workers == num_workers
+        assert dataloader.persistent_workers == (num_workers > 0)
+        assert dataloader.prefetch_factor == (3 if num_workers > 0 else 2)
+
+
 @pytest.mark.skipif(is_windows(), reason="Too slow on windows")
 def test_innereye_vision_module() -> None:
     """
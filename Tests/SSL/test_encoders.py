@@ -2,9 +2,14 @@
 #  Copyright (c) Microsoft Corporation. All rights reserved.
 #  Licensed under the MIT License (MIT). See LICENSE in the repo root for license information.
 #  ------------------------------------------------------------------------------------------
+from typing import Any, List
+from unittest import mock
+
+import torch
 from pl_bolts.models.self_supervised.resnets import ResNet
 
-from InnerEye.ML.SSL.encoders import DenseNet121Encoder, SSLEncoder
+from InnerEye.ML.SSL.encoders import DenseNet121Encoder, SSLEncoder, compile_ssl_encoders, \
+    to_encoder_memory_format
 from InnerEye.ML.SSL.lightning_containers.ssl_container import EncoderName
 
 
@@ -31,3 +36,35 @@ def test_use7x7conv_flag_in_encoder() -> None:
     assert resnet18.cnn_model.conv1.kernel_size == (7, 7)  # type: ignore
     resnet18_for_cifar = SSLEncoder(EncoderName.resnet18.value, use_7x7_first_conv_in_resnet=False)
     assert resnet18_for_cifar.cnn_model.conv1.kernel_size == (3, 3)  # type: ignore
+
+
+def test_compile_ssl_encoders() -> None:
+    """
+    Tests that compile_ssl_encoders compiles all SSL encoders in a model, but no other modules.
+    """
+    compiled: List[torch.nn.Module] = []
+
+    def mock_compile(self: torch.nn.Module, **kwargs: Any) -> None:
+        compiled.append(self)
+
+    encoder1 = SSLEncoder(EncoderName.resnet18.value)
+    encoder2 = SSLEncoder(EncoderName.resnet18.value)
+    model = torch.nn.ModuleDict({"online": encoder1, "target": encoder2, "head": torch.nn.Linear(512, 2)})
+    with mock.patch.object(torch.nn.Module, "compile", mock_compile, create=True):
+        compile_ssl_encoders(model)
+    assert len(compiled) == 2
+    assert compiled[0] is encoder1
+    assert compiled[1] is encoder2
+
+
+def test_to_encoder_memory_format() -> None:
+    """
+    Tests that images are only converted to channels-last if the encoder weights are in channels-last format.
+    """
+    encoder = SSLEncoder(EncoderName.resnet18.value)
+    x = torch.rand((2, 3, 32, 32))
+    assert to_encoder_memory_format(x, encoder) is x
+    encoder = encoder.to(memory_format=torch.channels_last)  # type: ignore
+    converted = to_encoder_memory_format(x, encoder)
+    assert converted.is_contiguous(memory_format=torch.channels_last)
+    assert torch.equal(converted, x)